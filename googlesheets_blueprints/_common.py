@@ -0,0 +1,372 @@
+"""
+Helpers shared by the clear, download and upload blueprints: authenticating
+and building the Google clients, on-disk caches that persist between runs,
+spreadsheet metadata and spreadsheet lookup by name.
+"""
+import os
+import json
+import tempfile
+import functools
+import hashlib
+import time
+import datetime
+import threading
+
+import httplib2
+import google_auth_httplib2
+from googleapiclient.discovery import build
+from googleapiclient.discovery_cache.base import Cache
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from googleapiclient.model import JsonModel
+from google.oauth2 import service_account
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SCOPES = ['https://spreadsheets.google.com/feeds',
+          'https://www.googleapis.com/auth/drive']
+DEFAULT_CELL_RANGE = 'A1:ZZZ5000000'
+# retries for rate limited (429) and server error (5xx) responses, with
+# exponential backoff
+NUM_RETRIES = 5
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'shipyard-gs')
+DISCOVERY_CACHE_SECONDS = 24 * 60 * 60
+DRIVE_CACHE_SECONDS = 60 * 60
+TOKEN_EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%S'
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+# sheet properties keyed by title, per spreadsheet id
+_SPREADSHEET_METADATA = {}
+_THREAD_LOCAL = threading.local()
+
+
+def is_json_credentials(credentials):
+    """
+    Checks whether the credentials were provided as a json string rather than
+    a path to a json credentials file.
+    """
+    return not os.path.isfile(credentials) and \
+        credentials.lstrip().startswith('{')
+
+
+def write_cache_file(file_name, content):
+    """
+    Atomically writes content to a file in the cache directory, readable only
+    by the current user. Failures are ignored since the cache is optional.
+    """
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=CACHE_DIR)
+        try:
+            os.write(fd, content.encode())
+        finally:
+            os.close(fd)
+        os.replace(path, os.path.join(CACHE_DIR, file_name))
+    except OSError:
+        pass
+
+
+class DiscoveryCache(Cache):
+    """
+    Keeps discovery documents on disk so they're only fetched from Google once
+    a day rather than on every run.
+    """
+
+    def get(self, url):
+        path = os.path.join(CACHE_DIR, self._file_name(url))
+        try:
+            if time.time() - os.path.getmtime(path) < DISCOVERY_CACHE_SECONDS:
+                with open(path) as f:
+                    return f.read()
+        except OSError:
+            pass
+        return None
+
+    def set(self, url, content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        write_cache_file(self._file_name(url), content)
+
+    @staticmethod
+    def _file_name(url):
+        return f'discovery-{hashlib.sha256(url.encode()).hexdigest()}.json'
+
+
+def load_cached_token(creds):
+    """
+    Reuses the access token minted for this service account by a previous run
+    while it's still valid. Otherwise a new token is minted and cached.
+    """
+    key = f'{creds.service_account_email} {" ".join(SCOPES)}'
+    file_name = f'token-{hashlib.sha256(key.encode()).hexdigest()}.json'
+    try:
+        with open(os.path.join(CACHE_DIR, file_name)) as f:
+            cached_token = json.load(f)
+        expiry = datetime.datetime.strptime(
+            cached_token['expiry'], TOKEN_EXPIRY_FORMAT)
+        if expiry - TOKEN_EXPIRY_MARGIN > datetime.datetime.utcnow():
+            creds.token = cached_token['token']
+            creds.expiry = expiry
+            return
+    except (OSError, ValueError, KeyError):
+        pass
+
+    creds.refresh(google_auth_httplib2.Request(httplib2.Http()))
+    write_cache_file(file_name, json.dumps({
+        'token': creds.token,
+        'expiry': creds.expiry.strftime(TOKEN_EXPIRY_FORMAT)}))
+
+
+class OrjsonModel(JsonModel):
+    """
+    Serializes request bodies with orjson, which is several times faster than
+    the json module on the large lists of cell values sent during uploads.
+    """
+
+    def serialize(self, body_value):
+        if (isinstance(body_value, dict) and 'data' not in body_value
+                and self._data_wrapper):
+            body_value = {'data': body_value}
+        return orjson.dumps(body_value)
+
+
+def get_thread_http(creds):
+    """
+    Returns an authorized Http for the current thread. httplib2 connections
+    aren't thread-safe, so each thread gets its own, and keeps its connections
+    alive across requests.
+    """
+    thread_https = _THREAD_LOCAL.__dict__.setdefault('https', {})
+    if creds not in thread_https:
+        thread_https[creds] = google_auth_httplib2.AuthorizedHttp(
+            creds, http=httplib2.Http())
+    return thread_https[creds]
+
+
+@functools.lru_cache(maxsize=4)
+def get_credentials(credentials):
+    """
+    Loads the service account credentials, reusing a cached access token
+    where possible.
+    """
+    if is_json_credentials(credentials):
+        creds = service_account.Credentials.from_service_account_info(
+            json.loads(credentials), scopes=SCOPES)
+    else:
+        creds = service_account.Credentials.from_service_account_file(
+            credentials, scopes=SCOPES)
+    load_cached_token(creds)
+    return creds
+
+
+@functools.lru_cache(maxsize=4)
+def get_service(credentials):
+    """
+    Attempts to create the Google Drive Client with the associated
+    environment variables. Clients are built once per set of credentials
+    and reused on subsequent calls.
+    """
+    try:
+        creds = get_credentials(credentials)
+
+        def build_request(http, *args, **kwargs):
+            return HttpRequest(get_thread_http(creds), *args, **kwargs)
+
+        http = get_thread_http(creds)
+        service = build('sheets', 'v4', http=http,
+                        model=OrjsonModel() if orjson else None,
+                        requestBuilder=build_request, cache=DiscoveryCache())
+        drive_service = build('drive', 'v3', http=http,
+                              requestBuilder=build_request,
+                              cache=DiscoveryCache())
+        return service, drive_service
+    except Exception as e:
+        if is_json_credentials(credentials):
+            print('Error accessing Google Drive with the provided service '
+                  'account')
+        else:
+            print(f'Error accessing Google Drive with service account '
+                  f'{credentials}')
+        raise(e)
+
+
+def get_sheet_properties(service, spreadsheet_id):
+    """
+    Fetches the properties of every sheet in the spreadsheet, keyed by sheet
+    title. The result is cached per spreadsheet so later lookups during the
+    same run don't refetch the spreadsheet metadata.
+    """
+    if spreadsheet_id not in _SPREADSHEET_METADATA:
+        spreadsheet = service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets.properties(title,sheetId)'
+            ).execute(num_retries=NUM_RETRIES)
+        _SPREADSHEET_METADATA[spreadsheet_id] = {
+            sheet['properties']['title']: sheet['properties']
+            for sheet in spreadsheet.get('sheets', [])}
+    return _SPREADSHEET_METADATA[spreadsheet_id]
+
+
+def record_added_sheets(spreadsheet_id, response):
+    """
+    Adds the sheets created by an addSheet batchUpdate to the cached
+    metadata, so they don't have to be refetched.
+    """
+    sheet_properties = _SPREADSHEET_METADATA.get(spreadsheet_id)
+    if sheet_properties is None:
+        return
+    for reply in response.get('replies', []):
+        properties = reply['addSheet']['properties']
+        sheet_properties[properties['title']] = properties
+
+
+def quote_tab_name(tab_name):
+    """
+    Quotes a tab name for use in A1 notation, so names with spaces or
+    brackets, or that look like a cell reference such as Q1, are read as
+    tab names.
+    """
+    return "'" + tab_name.replace("'", "''") + "'"
+
+
+def get_default_range(tab_name):
+    """
+    Picks the range to use when none was given: the whole of the named tab,
+    or the default range on the first sheet when no tab is given.
+    """
+    if tab_name:
+        return quote_tab_name(tab_name)
+    return DEFAULT_CELL_RANGE
+
+
+@functools.lru_cache(maxsize=4)
+def get_shared_drives(service):
+    """
+    Maps the names of all shared Google Drives to their ids. The listing is
+    fetched once per client and reused on subsequent calls.
+    """
+    drives = {}
+    page_token = None
+    while True:
+        results = service.drives().list(
+            pageSize=100,
+            pageToken=page_token,
+            fields='nextPageToken,drives(id,name)'
+        ).execute(num_retries=NUM_RETRIES)
+        for _drive in results.get('drives', []):
+            drives[_drive['name']] = _drive['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return drives
+
+
+def get_drive_cache_file_name(account):
+    """
+    Names the file caching the shared drive ids visible to the account.
+    """
+    return f'drives-{hashlib.sha256(account.encode()).hexdigest()}.json'
+
+
+def get_cached_drive_id(drive, account):
+    """
+    Returns the id cached on disk for the named shared drive by a recent run,
+    or None. Entries expire after an hour, so a drive renamed since is looked
+    up again.
+    """
+    if not account:
+        return None
+    path = os.path.join(CACHE_DIR, get_drive_cache_file_name(account))
+    try:
+        if time.time() - os.path.getmtime(path) < DRIVE_CACHE_SECONDS:
+            with open(path) as f:
+                return json.load(f).get(drive)
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def get_shared_drive_id(service, drive, account=None):
+    """
+    Search for the drive under shared Google Drives. When the service account
+    is given, the resolved ids are cached on disk so later runs skip the
+    lookup.
+    """
+    drive_ids = get_shared_drives(service)
+    if account:
+        write_cache_file(get_drive_cache_file_name(account),
+                         json.dumps(drive_ids))
+    return drive_ids.get(drive)
+
+
+def get_drive_id(drive, drive_id):
+    """
+    Falls back to the SHIPYARD_GS_DRIVE_ID environment variable only when
+    neither a drive name nor a drive id was given, so an explicit flag always
+    wins over the environment.
+    """
+    if drive or drive_id:
+        return drive_id
+    return os.environ.get('SHIPYARD_GS_DRIVE_ID')
+
+
+def get_spreadsheet_id_by_name(drive_service, file_name, drive,
+                               drive_id=None, account=None):
+    """
+    Attempts to get sheet id from the Google Drive Client using the
+    sheet name
+    """
+    try:
+        cached_drive_id = None
+        if drive and not drive_id:
+            cached_drive_id = get_cached_drive_id(drive, account)
+            drive_id = cached_drive_id or get_shared_drive_id(
+                drive_service, drive, account)
+
+        escaped_name = file_name.replace('\\', '\\\\').replace('"', '\\"')
+        query = 'mimeType="application/vnd.google-apps.spreadsheet"'
+        query += f' and name = "{escaped_name}"'
+        list_kwargs = {'q': query, 'spaces': 'drive', 'pageSize': 1,
+                       'fields': 'nextPageToken,files(id)'}
+        if drive or drive_id:
+            list_kwargs.update(supportsAllDrives=True,
+                               includeItemsFromAllDrives=True,
+                               corpora="drive",
+                               driveId=drive_id)
+
+        try:
+            file_id = find_file_id(drive_service, list_kwargs)
+        except HttpError as e:
+            if not cached_drive_id or e.resp.status not in (403, 404):
+                raise
+            file_id = None
+        if file_id or not cached_drive_id:
+            return file_id
+
+        # the cached id may be stale if the drive was renamed, deleted or
+        # unshared, so resolve it from a fresh listing and search again
+        list_kwargs['driveId'] = get_shared_drive_id(
+            drive_service, drive, account)
+        return find_file_id(drive_service, list_kwargs)
+    except Exception as e:
+        print(f'Failed to fetch spreadsheetId for {file_name}')
+        raise(e)
+
+
+def find_file_id(drive_service, list_kwargs):
+    """
+    Returns the id of the first file matched by a files().list query, or None.
+    """
+    # Drive may return an empty page before the end of the results, so only
+    # stop paging once a match is found or the pages run out.
+    page_token = None
+    while True:
+        results = drive_service.files().list(
+            pageToken=page_token, **list_kwargs
+        ).execute(num_retries=NUM_RETRIES)
+        files = results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if files or not page_token:
+            return files[0]['id'] if files else None
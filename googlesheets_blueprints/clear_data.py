@@ -1,23 +1,18 @@
 import os
-import re
 import json
-import csv
-import tempfile
 import argparse
 import socket
-import glob
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.oauth2 import service_account
+try:
+    from googlesheets_blueprints import _common
+except ImportError:
+    # run as a standalone script from within this directory
+    import _common
 
-SCOPES = ['https://spreadsheets.google.com/feeds',
-          'https://www.googleapis.com/auth/drive']
 socket.setdefaulttimeout(600)
 
 
-def get_args():
-    parser = argparse.ArgumentParser()
+def add_arguments(parser):
     parser.add_argument(
         '--destination-file-name',
         dest='file_name',
@@ -26,7 +21,7 @@ def get_args():
     parser.add_argument(
         '--cell-range',
         dest='cell_range',
-        default='A1:ZZZ5000000',
+        default=None,
         required=False)
     parser.add_argument(
         '--tab-name',
@@ -39,6 +34,16 @@ def get_args():
         default=None,
         required=True)
     parser.add_argument('--drive', dest='drive', default=None, required=False)
+    parser.add_argument(
+        '--drive-id',
+        dest='drive_id',
+        default=None,
+        required=False)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
     return parser.parse_args()
 
 
@@ -46,22 +51,17 @@ def set_environment_variables(args):
     """
     Set GCP credentials as environment variables if they're provided via keyword
     arguments rather than seeded as environment variables. This will override
-    system defaults.
+    system defaults. Json credentials are loaded directly from the string, so
+    nothing is written to disk for them.
     """
     credentials = args.gcp_application_credentials
-    try:
-        json_credentials = json.loads(credentials)
-        fd, path = tempfile.mkstemp()
-        print(f'Storing json credentials temporarily at {path}')
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(credentials)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
-        return path
-    except Exception:
-        print('Using specified json credentials file')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+    if _common.is_json_credentials(credentials):
+        print('Using specified json credentials')
         return
 
+    print('Using specified json credentials file')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+
 
 def clean_folder_name(folder_name):
     """
@@ -96,11 +96,14 @@ def clear_google_sheet(
                 body=file_metadata, fields='spreadsheetId').execute()
             spreadsheet_id = spreadsheet['spreadsheetId']
 
-        if tab_name:
+        if not cell_range:
+            cell_range = _common.get_default_range(tab_name=tab_name)
+        elif tab_name:
             cell_range = f'{tab_name}!{cell_range}'
 
         response = service.spreadsheets().values().clear(
-            spreadsheetId=spreadsheet_id, range=cell_range).execute()
+            spreadsheetId=spreadsheet_id, range=cell_range
+        ).execute(num_retries=_common.NUM_RETRIES)
     except Exception as e:
         if hasattr(e, 'content'):
             err_msg = json.loads(e.content)
@@ -111,82 +114,23 @@ def clear_google_sheet(
     print(f'{file_name} succcessfully cleared between range {cell_range}.')
 
 
-def get_shared_drive_id(service, drive):
-    """
-    Search for the drive under shared Google Drives.
-    """
-    drives = service.drives().list().execute()
-    drive_id = None
-    for _drive in drives['drives']:
-        if _drive['name'] == drive:
-            drive_id = _drive['id']
-    return drive_id
-
-
-def get_spreadsheet_id_by_name(drive_service, file_name, drive):
-    """
-    Attempts to get sheet id from the Google Drive Client using the
-    sheet name
-    """
-    try:
-        drive_id = None
-        if drive:
-            drive_id = get_shared_drive_id(drive_service, drive)
-
-        query = 'mimeType="application/vnd.google-apps.spreadsheet"'
-        query += f' and name = "{file_name}"'
-        if drive:
-            results = drive_service.files().list(
-                q=str(query),
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-                corpora="drive",
-                driveId=drive_id,
-                fields="files(id, name)").execute()
-        else:
-            results = drive_service.files().list(q=str(query)).execute()
-        files = results['files']
-        for _file in files:
-            return _file['id']
-        return None
-    except Exception as e:
-        print(f'Failed to fetch spreadsheetId for {file_name}')
-        raise(e)
-
-
-def get_service(credentials):
-    """
-    Attempts to create the Google Drive Client with the associated
-    environment variables
-    """
-    try:
-        creds = service_account.Credentials.from_service_account_file(
-            credentials, scopes=SCOPES)
-        service = build('sheets', 'v4', credentials=creds)
-        drive_service = build('drive', 'v3', credentials=creds)
-        return service, drive_service
-    except Exception as e:
-        print(f'Error accessing Google Drive with service account '
-              f'{credentials}')
-        raise(e)
-
-
-def main():
-    args = get_args()
-    tmp_file = set_environment_variables(args)
+def main(args=None):
+    if args is None:
+        args = get_args()
+    set_environment_variables(args)
     file_name = clean_folder_name(args.file_name)
     tab_name = args.tab_name
-    cell_range = 'A1:ZZZ5000000' if not args.cell_range else args.cell_range
+    cell_range = args.cell_range
     drive = args.drive
 
-    if tmp_file:
-        service, drive_service = get_service(credentials=tmp_file)
-    else:
-        service, drive_service = get_service(
-            credentials=args.gcp_application_credentials)
+    credentials = args.gcp_application_credentials
+    service, drive_service = _common.get_service(credentials=credentials)
+    account = _common.get_credentials(credentials).service_account_email
 
-    spreadsheet_id = get_spreadsheet_id_by_name(
-        drive_service=drive_service, file_name=file_name, drive=drive)
+    spreadsheet_id = _common.get_spreadsheet_id_by_name(
+        drive_service=drive_service, file_name=file_name, drive=drive,
+        drive_id=_common.get_drive_id(drive, args.drive_id),
+        account=account)
     if not spreadsheet_id:
         if len(file_name) >= 44:
             spreadsheet_id = file_name
@@ -200,10 +144,6 @@ def main():
                        tab_name=tab_name,
                        cell_range=cell_range)
 
-    if tmp_file:
-        print(f'Removing temporary credentials file {tmp_file}')
-        os.remove(tmp_file)
-
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,29 @@
+import argparse
+
+from googlesheets_blueprints import clear_data, download_file, upload_file
+
+COMMANDS = {
+    'clear': clear_data,
+    'download': download_file,
+    'upload': upload_file,
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, module in COMMANDS.items():
+        module.add_arguments(subparsers.add_parser(command))
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the clear, download or upload blueprint named by the subcommand.
+    """
+    args = get_args()
+    COMMANDS[args.command].main(args)
+
+
+if __name__ == '__main__':
+    main()
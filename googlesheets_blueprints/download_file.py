@@ -1,20 +1,18 @@
 import os
 import re
-import json
 import csv
-import tempfile
 import argparse
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.oauth2 import service_account
+from googleapiclient.errors import HttpError
 
-SCOPES = ['https://spreadsheets.google.com/feeds',
-          'https://www.googleapis.com/auth/drive']
+try:
+    from googlesheets_blueprints import _common
+except ImportError:
+    # run as a standalone script from within this directory
+    import _common
 
 
-def get_args():
-    parser = argparse.ArgumentParser()
+def add_arguments(parser):
     parser.add_argument(
         '--source-file-name',
         dest='file_name',
@@ -38,7 +36,7 @@ def get_args():
     parser.add_argument(
         '--cell-range',
         dest='cell_range',
-        default='A1:ZZZ5000000',
+        default=None,
         required=False)
     parser.add_argument(
         '--service-account',
@@ -46,6 +44,16 @@ def get_args():
         default=None,
         required=True)
     parser.add_argument('--drive', dest='drive', default=None, required=False)
+    parser.add_argument(
+        '--drive-id',
+        dest='drive_id',
+        default=None,
+        required=False)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
     return parser.parse_args()
 
 
@@ -53,22 +61,17 @@ def set_environment_variables(args):
     """
     Set GCP credentials as environment variables if they're provided via keyword
     arguments rather than seeded as environment variables. This will override
-    system defaults.
+    system defaults. Json credentials are loaded directly from the string, so
+    nothing is written to disk for them.
     """
     credentials = args.gcp_application_credentials
-    try:
-        json_credentials = json.loads(credentials)
-        fd, path = tempfile.mkstemp()
-        print(f'Storing json credentials temporarily at {path}')
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(credentials)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
-        return path
-    except Exception:
-        print('Using specified json credentials file')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+    if _common.is_json_credentials(credentials):
+        print('Using specified json credentials')
         return
 
+    print('Using specified json credentials file')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+
 
 def extract_file_name_from_source_full_path(source_full_path):
     """
@@ -95,7 +98,6 @@ def combine_folder_and_file_name(folder_name, file_name):
     """
     combined_name = os.path.normpath(
         f'{folder_name}{"/" if folder_name else ""}{file_name}')
-    combined_name = os.path.normpath(combined_name)
 
     return combined_name
 
@@ -145,24 +147,39 @@ def download_google_sheet_file(
     """
     local_path = os.path.normpath(f'{os.getcwd()}/{destination_file_name}')
     try:
-        if tab_name:
-            if check_workbook_exists(service=service,
-                                     spreadsheet_id=spreadsheet_id,
-                                     tab_name=tab_name):
-                cell_range = f'{tab_name}!{cell_range}'
-            else:
-                print(f'The tab {tab_name} could not be found')
+        user_cell_range = cell_range
+        if not cell_range:
+            cell_range = _common.get_default_range(tab_name=tab_name)
+        elif tab_name:
+            cell_range = f'{tab_name}!{cell_range}'
+        # a missing tab surfaces as an unparseable range, so the tab check
+        # and the values fetch share a single request
+        try:
+            response = service.spreadsheets().values().batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=[cell_range],
+                majorDimension='ROWS',
+                fields='valueRanges(values)'
+            ).execute(num_retries=_common.NUM_RETRIES)
+        except HttpError as e:
+            if e.resp.status == 400 and \
+                    'Unable to parse range' in str(e.content):
+                if tab_name and not user_cell_range:
+                    print(f'The tab {tab_name} could not be found')
+                else:
+                    print(f'The range {cell_range} could not be read. Check '
+                          'that the tab exists and the range is valid')
                 raise SystemExit(1)
-        sheet = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id,
-            range=cell_range).execute()
+            raise
 
-        if not sheet.get('values'):
+        value_ranges = response.get('valueRanges', [])
+        values = value_ranges[0].get('values') if value_ranges else None
+        if not values:
             print(f'No values for {file_name}.. Not downloading')
             return
 
-        values = sheet['values']
-        with open(local_path, '+w') as f:
+        with open(local_path, 'w', newline='', encoding='utf-8',
+                  buffering=1 << 20) as f:
             writer = csv.writer(f)
             writer.writerows(values)
         print(
@@ -172,89 +189,13 @@ def download_google_sheet_file(
         raise(e)
 
 
-def get_service(credentials):
-    """
-    Attempts to create the Google Drive Client with the associated
-    environment variables
-    """
-    try:
-        creds = service_account.Credentials.from_service_account_file(
-            credentials, scopes=SCOPES)
-        service = build('sheets', 'v4', credentials=creds)
-        drive_service = build('drive', 'v3', credentials=creds)
-        return service, drive_service
-    except Exception as e:
-        print(f'Error accessing Google Drive with service account '
-              f'{credentials}')
-        raise(e)
-
-
-def check_workbook_exists(service, spreadsheet_id, tab_name):
-    """
-    Checks if the workbook exists within the spreadsheet.
-    """
-    try:
-        spreadsheet = service.spreadsheets().get(
-            spreadsheetId=spreadsheet_id).execute()
-        sheets = spreadsheet['sheets']
-        exists = [True for sheet in sheets if sheet['properties']
-                  ['title'] == tab_name]
-        return True if exists else False
-    except Exception as e:
-        print(f'Failed to check workbook {tab_name} for spreadsheet '
-              f'{spreadsheet_id}')
-        raise(e)
-
-
-def get_shared_drive_id(service, drive):
-    """
-    Search for the drive under shared Google Drives.
-    """
-    drives = service.drives().list().execute()
-    drive_id = None
-    for _drive in drives['drives']:
-        if _drive['name'] == drive:
-            drive_id = _drive['id']
-    return drive_id
-
-
-def get_spreadsheet_id_by_name(drive_service, file_name, drive):
-    """
-    Attempts to get sheet id from the Google Drive Client using the
-    sheet name
-    """
-    try:
-        drive_id = None
-        if drive:
-            drive_id = get_shared_drive_id(drive_service, drive)
-
-        query = 'mimeType="application/vnd.google-apps.spreadsheet"'
-        query += f' and name = "{file_name}"'
-        if drive:
-            results = drive_service.files().list(
-                q=str(query),
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-                corpora="drive",
-                driveId=drive_id,
-                fields="files(id, name)").execute()
-        else:
-            results = drive_service.files().list(q=str(query)).execute()
-        files = results['files']
-        for _file in files:
-            return _file['id']
-        return None
-    except Exception as e:
-        print(f'Failed to fetch spreadsheetId for {file_name}')
-        raise(e)
-
-
-def main():
-    args = get_args()
-    tmp_file = set_environment_variables(args)
+def main(args=None):
+    if args is None:
+        args = get_args()
+    set_environment_variables(args)
     file_name = clean_folder_name(args.file_name)
     tab_name = args.tab_name
-    cell_range = 'A1:ZZZ5000000' if not args.cell_range else args.cell_range
+    cell_range = args.cell_range
     drive = args.drive
 
     destination_folder_name = clean_folder_name(args.destination_folder_name)
@@ -262,14 +203,14 @@ def main():
             (destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    if tmp_file:
-        service, drive_service = get_service(credentials=tmp_file)
-    else:
-        service, drive_service = get_service(
-            credentials=args.gcp_application_credentials)
+    credentials = args.gcp_application_credentials
+    service, drive_service = _common.get_service(credentials=credentials)
+    account = _common.get_credentials(credentials).service_account_email
 
-    spreadsheet_id = get_spreadsheet_id_by_name(
-        drive_service=drive_service, file_name=file_name, drive=drive)
+    spreadsheet_id = _common.get_spreadsheet_id_by_name(
+        drive_service=drive_service, file_name=file_name, drive=drive,
+        drive_id=_common.get_drive_id(drive, args.drive_id),
+        account=account)
     if not spreadsheet_id:
         if len(file_name) >= 44:
             spreadsheet_id = file_name
@@ -296,10 +237,6 @@ def main():
         cell_range=cell_range,
         destination_file_name=destination_name)
 
-    if tmp_file:
-        print(f'Removing temporary credentials file {tmp_file}')
-        os.remove(tmp_file)
-
 
 if __name__ == '__main__':
     main()
@@ -2,22 +2,25 @@ import os
 import re
 import json
 import csv
-import tempfile
 import argparse
+import itertools
 import socket
 import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from googlesheets_blueprints import _common
+except ImportError:
+    # run as a standalone script from within this directory
+    import _common
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.oauth2 import service_account
 
-SCOPES = ['https://spreadsheets.google.com/feeds',
-          'https://www.googleapis.com/auth/drive']
 socket.setdefaulttimeout(600)
+UPLOAD_CHUNK_ROWS = 50000
+MAX_WORKERS = 8
 
 
-def get_args():
-    parser = argparse.ArgumentParser()
+def add_arguments(parser):
     parser.add_argument(
         '--source-file-name',
         dest='source_file_name',
@@ -48,6 +51,16 @@ def get_args():
         default=None,
         required=True)
     parser.add_argument('--drive', dest='drive', default=None, required=False)
+    parser.add_argument(
+        '--drive-id',
+        dest='drive_id',
+        default=None,
+        required=False)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
     return parser.parse_args()
 
 
@@ -55,22 +68,17 @@ def set_environment_variables(args):
     """
     Set GCP credentials as environment variables if they're provided via keyword
     arguments rather than seeded as environment variables. This will override
-    system defaults.
+    system defaults. Json credentials are loaded directly from the string, so
+    nothing is written to disk for them.
     """
     credentials = args.gcp_application_credentials
-    try:
-        json_credentials = json.loads(credentials)
-        fd, path = tempfile.mkstemp()
-        print(f'Storing json credentials temporarily at {path}')
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(credentials)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
-        return path
-    except Exception:
-        print('Using specified json credentials file')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+    if _common.is_json_credentials(credentials):
+        print('Using specified json credentials')
         return
 
+    print('Using specified json credentials file')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+
 
 def clean_folder_name(folder_name):
     """
@@ -90,7 +98,6 @@ def combine_folder_and_file_name(folder_name, file_name):
     """
     combined_name = os.path.normpath(
         f'{folder_name}{"/" if folder_name else ""}{file_name}')
-    combined_name = os.path.normpath(combined_name)
 
     return combined_name
 
@@ -100,21 +107,17 @@ def check_workbook_exists(service, spreadsheet_id, tab_name):
     Checks if the workbook exists within the spreadsheet.
     """
     try:
-        spreadsheet = service.spreadsheets().get(
-            spreadsheetId=spreadsheet_id).execute()
-        sheets = spreadsheet['sheets']
-        exists = [True for sheet in sheets if sheet['properties']
-                  ['title'] == tab_name]
-        return True if exists else False
+        return tab_name in _common.get_sheet_properties(
+            service, spreadsheet_id)
     except Exception as e:
         print(f'Failed to check spreadsheet {spreadsheet_id} for a sheet '
               f'named {tab_name}')
         raise(e)
 
 
-def add_workbook(service, spreadsheet_id, tab_name):
+def add_workbook(service, spreadsheet_id, tab_names):
     """
-    Adds a workbook to the spreadsheet.
+    Adds one or more workbooks to the spreadsheet in a single request.
     """
     try:
         request_body = {
@@ -124,7 +127,7 @@ def add_workbook(service, spreadsheet_id, tab_name):
                         'title': tab_name,
                     }
                 }
-            }]
+            } for tab_name in tab_names]
         }
 
         response = service.spreadsheets().batchUpdate(
@@ -132,11 +135,47 @@ def add_workbook(service, spreadsheet_id, tab_name):
             body=request_body
         ).execute()
 
+        _common.record_added_sheets(spreadsheet_id, response)
+
         return response
     except Exception as e:
         print(e)
 
 
+def split_cell_reference(cell):
+    """
+    Splits an A1 notation cell such as 'B3' or '$B$3' into its column letters
+    and row number. Returns None for anything else, such as a bare column.
+    """
+    match = re.fullmatch(r'\$?([A-Za-z]+)\$?(\d+)', cell)
+    if not match:
+        return None
+    return match.group(1).upper(), int(match.group(2))
+
+
+def read_csv_rows(source_full_path):
+    """
+    Lazily reads the rows of a csv file, skipping any empty rows.
+    """
+    with open(source_full_path, newline='') as f:
+        reader = csv.reader((line.replace('\0', '')
+                             for line in f), delimiter=',')
+        # stripping any empty rows
+        yield from filter(any, reader)
+
+
+def chunk_rows(rows, chunk_size):
+    """
+    Groups rows into lists of at most chunk_size rows.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def upload_google_sheets_file(
         service,
         file_name,
@@ -147,6 +186,7 @@ def upload_google_sheets_file(
     """
     Uploads a single file to Google Sheets.
     """
+    pending_rows = None
     try:
         if not spreadsheet_id:
             file_metadata = {'properties': {
@@ -166,34 +206,46 @@ def upload_google_sheets_file(
                                                 tab_name=tab_name)
         if not workbook_exists:
             add_workbook(service=service, spreadsheet_id=spreadsheet_id,
-                         tab_name=tab_name)
-
-        data = []
-        with open(source_full_path, newline='') as f:
-            reader = csv.reader((line.replace('\0', '')
-                                 for line in f), delimiter=',')
-            for row in reader:
-                # stripping any empty rows
-                if set(row) != {''}:
-                    data.append(row)
-
-        if starting_cell:
-            _range = f'{starting_cell}:ZZZ5000000'
+                         tab_names=[tab_name])
+
+        # upload in fixed-size chunks so the whole file is never held in
+        # memory, each chunk starting where the previous one ended. Starting
+        # cells that can't be split are left for the API to resolve, so the
+        # file goes up in a single write.
+        starting_cell = starting_cell or 'A1'
+        cell = split_cell_reference(starting_cell)
+        rows = read_csv_rows(source_full_path)
+        if cell:
+            chunks = chunk_rows(rows, UPLOAD_CHUNK_ROWS)
         else:
-            _range = 'A1:ZZZ5000000'
-
-        if tab_name:
-            _range = f'{tab_name}!{_range}'
-
-        body = {'value_input_option': 'RAW',
-                'data': [{
-                    'values': data,
-                    'range': _range,
-                    'majorDimension': 'ROWS'}]
-                }
-        response = service.spreadsheets().values().batchUpdate(
-            spreadsheetId=spreadsheet_id, body=body).execute()
+            chunks = [list(rows)]
+        for index, data in enumerate(chunks):
+            if cell:
+                column, start_row = cell
+                row = start_row + index * UPLOAD_CHUNK_ROWS
+                _range = f'{column}{row}:ZZZ5000000'
+                pending_rows = f'{row}-{row + len(data) - 1}'
+            else:
+                _range = f'{starting_cell}:ZZZ5000000'
+                pending_rows = f'starting at {starting_cell}'
+            if tab_name:
+                _range = f'{_common.quote_tab_name(tab_name)}!{_range}'
+
+            body = {'value_input_option': 'RAW',
+                    'data': [{
+                        'values': data,
+                        'range': _range,
+                        'majorDimension': 'ROWS'}]
+                    }
+            response = service.spreadsheets().values().batchUpdate(
+                spreadsheetId=spreadsheet_id, body=body
+            ).execute(num_retries=_common.NUM_RETRIES)
+            pending_rows = None
     except Exception as e:
+        if pending_rows:
+            print(f'Failed to write sheet rows {pending_rows} from '
+                  f'{source_full_path}. Any earlier rows were already '
+                  'uploaded')
         if isinstance(e, FileNotFoundError):
             print(f'File {source_full_path} does not exist.')
         elif hasattr(e, 'content'):
@@ -210,69 +262,91 @@ def upload_google_sheets_file(
     print(f'{source_full_path} successfully uploaded to {file_name}')
 
 
-def get_shared_drive_id(service, drive):
+def upload_google_sheets_files(
+        service,
+        file_name,
+        source_full_paths,
+        starting_cell,
+        spreadsheet_id):
     """
-    Search for the drive under shared Google Drives.
+    Uploads several files to the same spreadsheet concurrently, each one to a
+    tab named after the file.
     """
-    drives = service.drives().list().execute()
-    drive_id = None
-    for _drive in drives['drives']:
-        if _drive['name'] == drive:
-            drive_id = _drive['id']
-    return drive_id
-
+    tab_names = {
+        source_full_path: os.path.splitext(
+            os.path.basename(source_full_path))[0]
+        for source_full_path in source_full_paths}
+
+    # files sharing a tab would be written to it concurrently, interleaving
+    # their chunks, so refuse to upload them. Sheets ignores case when
+    # matching tab titles, so compare them the same way.
+    files_by_tab_name = {}
+    for source_full_path, tab_name in tab_names.items():
+        files_by_tab_name.setdefault(
+            tab_name.casefold(), []).append(source_full_path)
+    colliding_files = [source_paths for source_paths
+                       in files_by_tab_name.values() if len(source_paths) > 1]
+    if colliding_files:
+        for source_paths in colliding_files:
+            print(f'Files {", ".join(source_paths)} would all be uploaded '
+                  'to the same tab')
+        raise SystemExit(1)
 
-def get_spreadsheet_id_by_name(drive_service, file_name, drive):
-    """
-    Attempts to get sheet id from the Google Drive Client using the
-    sheet name
-    """
-    try:
-        drive_id = None
-        if drive:
-            drive_id = get_shared_drive_id(drive_service, drive)
-
-        query = 'mimeType="application/vnd.google-apps.spreadsheet"'
-        query += f' and name = "{file_name}"'
-        if drive:
-            results = drive_service.files().list(
-                q=str(query),
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-                corpora="drive",
-                driveId=drive_id,
-                fields="files(id, name)").execute()
+    # create every missing tab in one request up front, so the workers find
+    # them in the cached metadata rather than each adding their own
+    sheet_properties = _common.get_sheet_properties(service, spreadsheet_id)
+    existing_tab_names = {title.casefold(): title
+                          for title in sheet_properties}
+    missing_tab_names = []
+    for source_full_path, tab_name in tab_names.items():
+        existing_tab_name = existing_tab_names.get(tab_name.casefold())
+        if existing_tab_name:
+            # upload to the existing tab under its own title
+            tab_names[source_full_path] = existing_tab_name
         else:
-            results = drive_service.files().list(q=str(query)).execute()
-        files = results['files']
-        for _file in files:
-            return _file['id']
-        return None
-    except Exception as e:
-        print(f'Failed to fetch spreadsheetId for {file_name}')
-        raise(e)
-
+            missing_tab_names.append(tab_name)
+    if missing_tab_names:
+        response = add_workbook(service=service,
+                                spreadsheet_id=spreadsheet_id,
+                                tab_names=missing_tab_names)
+        if response is None:
+            print(f'Failed to add tabs {", ".join(missing_tab_names)} to '
+                  f'{file_name}')
+            raise SystemExit(1)
 
-def get_service(credentials):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                upload_google_sheets_file,
+                service=service,
+                file_name=file_name,
+                source_full_path=source_full_path,
+                spreadsheet_id=spreadsheet_id,
+                tab_name=tab_name,
+                starting_cell=starting_cell)
+            for source_full_path, tab_name in tab_names.items()]
+        for future in as_completed(futures):
+            future.result()
+
+
+def find_source_files(source_full_path):
     """
-    Attempts to create the Google Drive Client with the associated
-    environment variables
+    Returns the files matching source_full_path, which may be a glob pattern.
+    An existing file is always taken literally, even if its name contains
+    glob characters.
     """
-    try:
-        creds = service_account.Credentials.from_service_account_file(
-            credentials, scopes=SCOPES)
-        service = build('sheets', 'v4', credentials=creds)
-        drive_service = build('drive', 'v3', credentials=creds)
-        return service, drive_service
-    except Exception as e:
-        print(f'Error accessing Google Drive with service account '
-              f'{credentials}')
-        raise(e)
-
-
-def main():
-    args = get_args()
-    tmp_file = set_environment_variables(args)
+    if os.path.isfile(source_full_path):
+        return [source_full_path]
+    if glob.escape(source_full_path) == source_full_path:
+        return []
+    return sorted(path for path in glob.glob(source_full_path)
+                  if os.path.isfile(path))
+
+
+def main(args=None):
+    if args is None:
+        args = get_args()
+    set_environment_variables(args)
     source_file_name = args.source_file_name
     source_folder_name = args.source_folder_name
     source_full_path = combine_folder_and_file_name(
@@ -280,21 +354,22 @@ def main():
         file_name=source_file_name)
     file_name = clean_folder_name(args.file_name)
     tab_name = args.tab_name
-    starting_cell = 'A1' if not args.starting_cell else args.starting_cell
+    starting_cell = args.starting_cell
     drive = args.drive
 
-    if not os.path.isfile(source_full_path):
+    source_full_paths = find_source_files(source_full_path)
+    if not source_full_paths:
         print(f'{source_full_path} does not exist')
         raise SystemExit(1)
 
-    if tmp_file:
-        service, drive_service = get_service(credentials=tmp_file)
-    else:
-        service, drive_service = get_service(
-            credentials=args.gcp_application_credentials)
+    credentials = args.gcp_application_credentials
+    service, drive_service = _common.get_service(credentials=credentials)
+    account = _common.get_credentials(credentials).service_account_email
 
-    spreadsheet_id = get_spreadsheet_id_by_name(
-        drive_service=drive_service, file_name=file_name, drive=drive)
+    spreadsheet_id = _common.get_spreadsheet_id_by_name(
+        drive_service=drive_service, file_name=file_name, drive=drive,
+        drive_id=_common.get_drive_id(drive, args.drive_id),
+        account=account)
     if not spreadsheet_id:
         if len(file_name) >= 44:
             spreadsheet_id = file_name
@@ -302,16 +377,21 @@ def main():
             print(f'The spreadsheet {file_name} does not exist')
             raise SystemExit(1)
 
-    # check if workbook exists in the spreadsheet
-    upload_google_sheets_file(service=service, file_name=file_name,
-                              source_full_path=source_full_path,
-                              spreadsheet_id=spreadsheet_id,
-                              tab_name=tab_name,
-                              starting_cell=starting_cell)
-
-    if tmp_file:
-        print(f'Removing temporary credentials file {tmp_file}')
-        os.remove(tmp_file)
+    if len(source_full_paths) > 1:
+        if tab_name:
+            print(f'Ignoring tab name {tab_name} since {source_file_name} '
+                  'matches several files; each file is uploaded to a tab '
+                  'named after it')
+        upload_google_sheets_files(service=service, file_name=file_name,
+                                   source_full_paths=source_full_paths,
+                                   spreadsheet_id=spreadsheet_id,
+                                   starting_cell=starting_cell)
+    else:
+        upload_google_sheets_file(service=service, file_name=file_name,
+                                  source_full_path=source_full_paths[0],
+                                  spreadsheet_id=spreadsheet_id,
+                                  tab_name=tab_name,
+                                  starting_cell=starting_cell)
 
 
 if __name__ == '__main__':
@@ -19,6 +19,14 @@ config = {
     "author_email": "tech@shipyardapp.com",
     "packages": find_packages(),
     "install_requires": install_requires,
+    "extras_require": {
+        "fast": ["orjson"],
+    },
+    "entry_points": {
+        "console_scripts": [
+            "googlesheets-blueprints=googlesheets_blueprints.cli:main",
+        ],
+    },
     "name": "googlesheets-blueprints",
     "version": "v0.1.0",
     "license": "Apache-2.0",